@@ -5,8 +5,44 @@ from datetime import datetime
 import os
 from dotenv import load_dotenv
 import time
+import random
 import traceback
 import re
+import html
+from collections import defaultdict
+from bisect import bisect_left, insort
+from itertools import chain
+
+try:
+    import re2
+    HAVE_RE2 = True
+except ImportError:
+    HAVE_RE2 = False
+
+# linear-time engine for the classifier patterns when google-re2 is installed
+_fast_re = re2 if HAVE_RE2 else re
+
+# ------------------- PATTERNS -------------------
+_BULK_RE = re.compile(r"^[ \t]*(?:[-*•]|\d+[.)])?[ \t]*(\w+)\s+—\s+[\d\-\:\s]+(.+)$", re.MULTILINE)
+_WORD_RE = _fast_re.compile(r"[a-z]+(?:-[a-z]+)*")
+# verb and noun stems, matched as word prefixes ("listing", "buying", "to-dos")
+QUERY_VERBS = ("what", "show", "list", "display")
+QUERY_NOUNS = [
+    (("shopping", "buy", "grocer", "item"), "shoppinglist"),
+    (("remind", "task", "todo", "to-do", "event"), "reminder"),
+    (("note", "thought", "idea", "recommendation"), "note"),
+]
+_EVENT_RE = _fast_re.compile(r"(remind|appointment|meeting|schedule|event)")
+_ADD_NEG_RE = _fast_re.compile(r"(add|note)")
+_Q_LOOSE_RE = _fast_re.compile(r"(do|does|did|any|what|show|list|display|have|are there)")
+_SPLIT_RE = re.compile(r"(?:(?<=\.)|(?<=\n)|(?<=and ))(?=\s*add )", re.IGNORECASE)
+_SHOP_ADD_RE = _fast_re.compile(r"(to shopping list|to buy|list to buy)")
+_SHOP_ITEM_RE = re.compile(r"(?:buy|for|to buy|list to buy)\s+(.*)", re.IGNORECASE)
+_Q_WORDS_RE = _fast_re.compile(r"\b(do|does|did|any|what|show|list|display|have|are there)\b")
+CONTEXT_KEYWORDS = ["what", "list", "show", "remind", "buy", "task", "to-do", "remember", "summary", "note"]
+_CONTEXT_RE = _fast_re.compile("|".join(map(re.escape, CONTEXT_KEYWORDS)))
+KEYWORD_CATEGORIES = {"buy": "shoppinglist", "remind": "reminder", "task": "reminder", "to-do": "reminder", "note": "note"}
+_TOKEN_RE = re.compile(r"\w+")
 
 # ------------------- SETUP -------------------
 load_dotenv()
@@ -16,29 +52,93 @@ if "journal_entries" not in st.session_state:
     st.session_state.journal_entries = []
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
+if "entries_by_cat" not in st.session_state:
+    st.session_state.entries_by_cat = defaultdict(list)
+if "token_index" not in st.session_state:
+    st.session_state.token_index = defaultdict(set)
+if "vocabulary" not in st.session_state:
+    st.session_state.vocabulary = []
+if "entries_version" not in st.session_state:
+    st.session_state.entries_version = 0
+if "response_cache" not in st.session_state:
+    st.session_state.response_cache = {}
+if "sidebar_html" not in st.session_state:
+    st.session_state.sidebar_html = (None, "")
 
 api_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
 if not api_key:
     st.error("⚠️ Missing GEMINI_API_KEY or GOOGLE_API_KEY in .env file.")
     st.stop()
 
+MAX_OUTPUT_TOKENS = 256
+REQUEST_TIMEOUT_MS = 20_000
+MAX_RETRIES = 3
+BACKOFF_BASE = 2.0
+BACKOFF_CAP = 30.0
+CONTEXT_MAX_ENTRIES = 10
+CONTEXT_TOKEN_BUDGET = 800
+RESPONSE_CACHE_SIZE = 64
+
 # ------------------- CLIENT CACHE -------------------
 @st.cache_resource
 def get_client(api_key: str):
     """Initialize genai client once per session."""
-    return genai.Client(api_key=api_key)
+    return genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=REQUEST_TIMEOUT_MS))
+
+@st.cache_resource
+def get_config():
+    """Build the generation config once per server process, not on every rerun."""
+    return types.GenerateContentConfig(
+        system_instruction=get_system_instruction(),
+        tools=[add_entry_tool, query_entries_tool],
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        temperature=0.2,
+    )
 
 # ------------------- RETRY HANDLER -------------------
-def safe_generate(client, model, contents, config, retries=3):
-    """Retries on 429 or transient errors (silently)."""
-    for attempt in range(retries):
+def is_retryable(e: Exception) -> bool:
+    """True for rate limits (429) and server-side (5xx) failures."""
+    code = getattr(e, "code", None)
+    if isinstance(code, int):
+        return code == 429 or 500 <= code < 600
+    return "429" in str(e) or "rate" in str(e).lower()
+
+def retry_delay(e: Exception, attempt: int) -> float:
+    """Honor Retry-After when the error carries one, else exponential backoff with jitter."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return min(BACKOFF_CAP, float(headers.get("retry-after")))
+    except (TypeError, ValueError):
+        return min(BACKOFF_CAP, BACKOFF_BASE * (1.5 ** attempt)) + random.uniform(0, 1.0)
+
+def safe_generate(client, model, contents, config, max_retries=MAX_RETRIES):
+    """Retries on 429 or transient errors (silently), at most max_retries times."""
+    for attempt in range(max_retries):
         try:
             return client.models.generate_content(model=model, contents=contents, config=config)
         except Exception as e:
-            if "429" in str(e) or "rate" in str(e).lower():
-                time.sleep((attempt + 1) * 5)
-            else:
+            if not is_retryable(e):
                 raise
+            if attempt < max_retries - 1:
+                time.sleep(retry_delay(e, attempt))
+    raise RuntimeError("Failed after multiple retries due to rate limits.")
+
+def safe_generate_stream(client, model, contents, config, max_retries=MAX_RETRIES):
+    """Streaming safe_generate; retries only until the first chunk arrives."""
+    for attempt in range(max_retries):
+        try:
+            stream = iter(client.models.generate_content_stream(model=model, contents=contents, config=config))
+            first = next(stream, None)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            if attempt < max_retries - 1:
+                time.sleep(retry_delay(e, attempt))
+            continue
+        if first is not None:
+            yield first
+        yield from stream
+        return
     raise RuntimeError("Failed after multiple retries due to rate limits.")
 
 # ------------------- JOURNAL TOOLS -------------------
@@ -77,39 +177,107 @@ query_entries_tool = types.Tool(
 )
 
 # ------------------- FUNCTIONS -------------------
-def add_journal_entry(content, category, tags=None):
-    entry = {
-        "id": len(st.session_state.journal_entries) + 1,
+def make_entry(entry_id, content, category, tags, timestamp, timestamp_display):
+    return {
+        "id": entry_id,
         "content": content.strip(),
+        "content_lower": content.strip().lower(),
         "category": category.strip().lower(),
         "tags": tags or [],
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": timestamp,
+        "timestamp_display": timestamp_display,
     }
+
+def add_journal_entry(content, category, tags=None):
+    now = datetime.now()
+    entry = make_entry(
+        len(st.session_state.journal_entries) + 1, content, category, tags,
+        now.isoformat(), now.strftime('%Y-%m-%d %H:%M'),
+    )
     st.session_state.journal_entries.append(entry)
+    index_entry(entry)
+    st.session_state.entries_version += 1
     return {"success": True, "message": f"Added {category} entry."}
 
+def add_journal_entries(entries):
+    """Batch add for bulk pastes: one timestamp and one extend for all entries."""
+    base_id = len(st.session_state.journal_entries)
+    now = datetime.now()
+    timestamp, timestamp_display = now.isoformat(), now.strftime('%Y-%m-%d %H:%M')
+    new_entries = [
+        make_entry(base_id + i, e["content"], e["category"], e["tags"], timestamp, timestamp_display)
+        for i, e in enumerate(entries, start=1)
+    ]
+    st.session_state.journal_entries.extend(new_entries)
+    for entry in new_entries:
+        index_entry(entry)
+    st.session_state.entries_version += 1
+
+def index_entry(entry):
+    st.session_state.entries_by_cat[entry["category"]].append(entry)
+    index = st.session_state.token_index
+    for token in set(_TOKEN_RE.findall(entry["content_lower"])):
+        if token not in index:
+            insort(st.session_state.vocabulary, token)
+        index[token].add(entry["id"])
+
+def words_with_prefix(prefix):
+    vocabulary = st.session_state.vocabulary
+    i = bisect_left(vocabulary, prefix)
+    while i < len(vocabulary) and vocabulary[i].startswith(prefix):
+        yield vocabulary[i]
+        i += 1
+
+def search_candidates(query_lower):
+    """Ids of entries containing every query word (the last as a prefix); None if there are no words."""
+    tokens = _TOKEN_RE.findall(query_lower)
+    if not tokens:
+        return None
+    index = st.session_state.token_index
+    candidates = None
+    for token in tokens[:-1]:
+        ids = index.get(token, set())
+        candidates = ids if candidates is None else candidates & ids
+        if not candidates:
+            return set()
+    # the query may end mid-word
+    ids = set().union(*(index[w] for w in words_with_prefix(tokens[-1])))
+    return ids if candidates is None else candidates & ids
+
 def query_journal_entries(category="all", search_query=None):
-    entries = st.session_state.journal_entries
-    if category != "all":
-        entries = [e for e in entries if e["category"].lower() == category.lower()]
+    category = category.lower()
+    candidates = None
     if search_query:
-        entries = [e for e in entries if search_query.lower() in e["content"].lower()]
+        query_lower = search_query.lower()
+        candidates = search_candidates(query_lower)
+    if candidates is not None:
+        journal = st.session_state.journal_entries
+        entries = [journal[i - 1] for i in sorted(candidates)]
+        if category != "all":
+            entries = [e for e in entries if e["category"] == category]
+    elif category != "all":
+        entries = st.session_state.entries_by_cat.get(category, [])
+    else:
+        entries = st.session_state.journal_entries
+    if search_query:
+        entries = [e for e in entries if query_lower in e["content_lower"]]
     if not entries:
         return {"result": "No entries found."}
 
     formatted = "\n".join(
-        f"- [{e['category']}] {e['content']} ({datetime.fromisoformat(e['timestamp']).strftime('%Y-%m-%d %H:%M')})"
+        f"- [{e['category']}] {e['content']} ({e['timestamp_display']})"
         for e in entries
     )
     return {"result": formatted}
 
-def execute_function(function_call):
-    name = function_call.name
-    args = dict(function_call.args)
+def execute_function(name, args):
+    args = args or {}
     if name == "add_journal_entry":
-        return add_journal_entry(**args)
+        if not args.get("content"):
+            return {"error": "Missing content"}
+        return add_journal_entry(args["content"], args.get("category") or "note", args.get("tags"))
     elif name == "query_journal_entries":
-        return query_journal_entries(**args)
+        return query_journal_entries(args.get("category") or "all", args.get("search_query"))
     return {"error": "Unknown function"}
 
 def get_system_instruction():
@@ -137,65 +305,109 @@ Restrictions:
 Keep responses short and natural."""
 
 # ------------------- CONTEXT DECIDER -------------------
-def should_include_context(user_message: str) -> bool:
-    keywords = ["what", "list", "show", "remind", "buy", "task", "to-do", "remember", "summary", "note"]
-    return any(k in user_message.lower() for k in keywords)
+def should_include_context(text_lower: str) -> bool:
+    """Expects the already-lowercased user message."""
+    return _CONTEXT_RE.search(text_lower) is not None
+
+def mentioned_categories(text_lower: str) -> set:
+    return {KEYWORD_CATEGORIES[k] for k in _CONTEXT_RE.findall(text_lower) if k in KEYWORD_CATEGORIES}
+
+def build_context(entries, categories) -> str:
+    """Newest entries first (restricted to categories, if any) until the token budget runs out."""
+    lines = []
+    budget = CONTEXT_TOKEN_BUDGET
+    for e in reversed(entries):
+        if categories and e["category"] not in categories:
+            continue
+        line = f"- [{e['category']}] {e['content']}"
+        cost = len(line) // 4 + 1  # rough token estimate
+        if cost > budget:
+            # keep what fits of this entry instead of dropping it
+            if budget > 0:
+                lines.append(line[: budget * 4 - 1].rstrip() + "…")
+            break
+        budget -= cost
+        lines.append(line)
+        if len(lines) == CONTEXT_MAX_ENTRIES:
+            break
+    if not lines:
+        return ""
+    return "Here are recent journal entries:\n" + "\n".join(reversed(lines))
+
+# ------------------- QUERY CLASSIFIER -------------------
+def query_words(text_lower: str):
+    """Words in order; a hyphenated word comes first whole, then as its parts."""
+    for word in _WORD_RE.findall(text_lower):
+        yield word
+        if "-" in word:
+            yield from word.split("-")
+
+def classify_query(text_lower: str):
+    """Category of a list query (a verb followed later by a category noun), or None."""
+    found = set()
+    verb_seen = False
+    prev_category = None
+    for word in query_words(text_lower):
+        category = next((c for stems, c in QUERY_NOUNS if word.startswith(stems)), None)
+        if verb_seen and category:
+            found.add(category)
+        # "list" right after a noun is part of the name ("shopping list"), not a verb
+        if word.startswith(QUERY_VERBS) and not (prev_category and word.startswith("list")):
+            verb_seen = True
+        prev_category = category
+    return next((c for _, c in QUERY_NOUNS if c in found), None)
 
 # ------------------- BULK ENTRY DETECTOR -------------------
 def parse_bulk_entries(text: str):
-    pattern = r"(\w+)\s+—\s+[\d\-\:\s]+(.+)"
-    matches = re.findall(pattern, text)
-    return [{"category": c.strip(), "content": x.strip(), "tags": []} for c, x in matches]
+    return [
+        {"category": m.group(1), "content": m.group(2).strip(), "tags": []}
+        for m in _BULK_RE.finditer(text)
+    ]
 
 # ------------------- PROCESS MESSAGE -------------------
-def process_message(user_message: str) -> str:
+def process_message_stream(user_message: str):
+    """Yields the reply in chunks; rule-based replies arrive as a single chunk."""
     try:
-        client = get_client(api_key)
         text = user_message.strip().lower()
 
         # --- 1️⃣ Bulk entry paste handling ---
         bulk_entries = parse_bulk_entries(user_message)
         if bulk_entries:
-            for entry in bulk_entries:
-                add_journal_entry(entry["content"], entry["category"], entry["tags"])
-            return f"✅ Added {len(bulk_entries)} journal entries successfully."
+            add_journal_entries(bulk_entries)
+            yield f"✅ Added {len(bulk_entries)} journal entries successfully."
+            return
         
         # ---  2️⃣ Handle manual list queries before LLM ---
-        if re.search(r"(what|show|list|display).*(shopping|buy|grocer|item)", text) and not re.search(r"(add|note)", text):
-            result = query_journal_entries("shoppinglist")
-            return result["result"]
-
-        if re.search(r"(what|show|list|display).*(remind|task|todo|to-do|event)", text) and not re.search(r"(add|note)", text):
-            result = query_journal_entries("reminder")
-            return result["result"]
-
-        if re.search(r"(what|show|list|display).*(note|thought|idea|recommendation)", text) and not re.search(r"(add|note)", text):
-            result = query_journal_entries("note")
-            return result["result"]
+        category = classify_query(text)
+        if category and not _ADD_NEG_RE.search(text):
+            yield query_journal_entries(category)["result"]
+            return
         
-        if re.search(r"(remind|appointment|meeting|schedule|event)", text) and not re.search(r"(add|note)", text):
-                if re.search(r"(do|does|did|any|what|show|list|display|have|are there)", text):
+        if _EVENT_RE.search(text) and not _ADD_NEG_RE.search(text):
+                if _Q_LOOSE_RE.search(text):
                     result = query_journal_entries("reminder")
-                    return result["result"]
+                    yield result["result"]
+                    return
 
 
         # --- 3️⃣ NLP for implicit adds ---
-        actions = re.split(r"(?:(?<=\.)|(?<=\n)|(?<=and ))(?=\s*add )", user_message, flags=re.IGNORECASE)
+        actions = _SPLIT_RE.split(user_message)
         added_count = 0
         for action in actions:
             if not action.strip():
                 continue
+            action_lower = action.lower()
 
-            if re.search(r"(to shopping list|to buy|list to buy)", action, re.IGNORECASE):
-                match = re.findall(r"(?:buy|for|to buy|list to buy)\s+(.*)", action, re.IGNORECASE)
+            if _SHOP_ADD_RE.search(action_lower):
+                match = _SHOP_ITEM_RE.findall(action)
                 if match:
                     add_journal_entry(match[0].strip(), "shoppinglist")
                     added_count += 1
                 continue
 
-            if re.search(r"(remind|appointment|meeting|schedule|event)", action, re.IGNORECASE):
+            if _EVENT_RE.search(action_lower):
                 # avoid false positives for questions
-                if re.search(r"\b(do|does|did|any|what|show|list|display|have|are there)\b", action, re.IGNORECASE):
+                if _Q_WORDS_RE.search(action_lower):
                     continue  # this is likely a query, not an add
                 add_journal_entry(action, "reminder")
                 added_count += 1
@@ -203,38 +415,41 @@ def process_message(user_message: str) -> str:
 
 
         if added_count:
-            return f"✅ Added {added_count} journal entr{'y' if added_count == 1 else 'ies'} successfully."
+            yield f"✅ Added {added_count} journal entr{'y' if added_count == 1 else 'ies'} successfully."
+            return
 
         # --- 4️⃣ Contextual LLM step for everything else ---
+        cache = st.session_state.response_cache
+        cache_key = (user_message, st.session_state.entries_version)
+        if cache_key in cache:
+            yield cache[cache_key]
+            return
+
         context_text = ""
-        if should_include_context(user_message) and st.session_state.journal_entries:
-            recent = st.session_state.journal_entries[-10:]
-            context_text = "Here are recent journal entries:\n" + "\n".join(
-                [f"- [{e['category']}] {e['content']}" for e in recent]
-            )
+        if should_include_context(text) and st.session_state.journal_entries:
+            context_text = build_context(st.session_state.journal_entries, mentioned_categories(text))
 
         contents = [context_text, user_message] if context_text else [user_message]
 
-        config = types.GenerateContentConfig(
-            system_instruction=get_system_instruction(),
-            tools=[add_entry_tool, query_entries_tool],
-        )
-
-        response = safe_generate(client, "models/gemini-2.0-flash-lite", contents, config)
+        client = get_client(api_key)
+        config = get_config()
+        reply = []
+        function_calls = []
+        for chunk in safe_generate_stream(client, "models/gemini-2.0-flash-lite", contents, config):
+            if not chunk.candidates or not chunk.candidates[0].content:
+                continue
+            for part in chunk.candidates[0].content.parts or []:
+                if part.function_call:
+                    function_calls.append(part.function_call)
+                elif part.text:
+                    reply.append(part.text)
+                    yield part.text
 
         # --- 5️⃣ Tool execution if model triggers it ---
-        function_calls = [
-            part.function_call for part in response.candidates[0].content.parts
-            if hasattr(part, "function_call") and part.function_call
-        ]
-
         if function_calls:
             results = []
             for func_call in function_calls:
-                args = dict(func_call.args or {})
-                if "category" in args and not args["category"]:
-                    args["category"] = "note"
-                result = execute_function(types.FunctionCall(name=func_call.name, args=args))
+                result = execute_function(func_call.name, func_call.args)
                 results.append(types.Part.from_function_response(name=func_call.name, response=result))
 
             response = safe_generate(
@@ -246,41 +461,48 @@ def process_message(user_message: str) -> str:
                 ],
                 config,
             )
-            return response.text
+            if response.text:
+                reply.append(response.text)
+                yield response.text
 
-        return response.text
+        # a tool call that added entries makes cache_key unreachable
+        if st.session_state.entries_version == cache_key[1]:
+            if len(cache) >= RESPONSE_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
+            cache[cache_key] = "".join(reply)
 
     except Exception as e:
         traceback.print_exc()
-        return f"❌ Error: {str(e)}"
+        yield f"❌ Error: {str(e)}"
 
 # ------------------- SIDEBAR -------------------
-with st.sidebar:
-    st.title("📒 Journal Entries")
-    st.metric("Total Entries", len(st.session_state.journal_entries))
-
-    if st.session_state.journal_entries:
-        for entry in reversed(st.session_state.journal_entries):
-            content_text = entry['content'].strip() or "🗒️ No details available"
-            st.markdown(
-                f"""
-                <div style='background-color:#f9fafb;padding:10px;border-radius:10px;margin-bottom:10px;
-                border:1px solid #eee;box-shadow:0 1px 3px rgba(0,0,0,0.05)'>
-                    <b style='color:#333'>{entry['category'].capitalize()}</b><br>
-                    <small style='color:#888'>{datetime.fromisoformat(entry['timestamp']).strftime('%Y-%m-%d %H:%M')}</small><br>
-                    <div style='margin-top:4px;color:#444'>{content_text}</div>
-                    <div style='margin-top:6px;font-size:12px;color:#666'>
-                        <i>Tags:</i> {', '.join(entry['tags']) if entry['tags'] else 'None'}
-                    </div>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
+def render_entry(category, timestamp_display, content, tags):
+    # No indentation or raw newlines: the cards share one markdown body, where an
+    # indented line would turn into a code block for every card after it.
+    content_text = html.escape(content.strip()).replace("\n", "<br>") or "🗒️ No details available"
+    tags_text = html.escape(", ".join(tags)) if tags else "None"
+    return (
+        "<div style='background-color:#f9fafb;padding:10px;border-radius:10px;margin-bottom:10px;"
+        "border:1px solid #eee;box-shadow:0 1px 3px rgba(0,0,0,0.05)'>"
+        f"<b style='color:#333'>{html.escape(category.capitalize())}</b><br>"
+        f"<small style='color:#888'>{timestamp_display}</small><br>"
+        f"<div style='margin-top:4px;color:#444'>{content_text}</div>"
+        "<div style='margin-top:6px;font-size:12px;color:#666'>"
+        f"<i>Tags:</i> {tags_text}"
+        "</div>"
+        "</div>\n"
+    )
 
-    if st.button("🗑️ Clear All Entries", use_container_width=True):
-        st.session_state.journal_entries.clear()
-        st.session_state.chat_history.clear()
-        st.rerun()
+def sidebar_html():
+    """All entry cards, newest first; rebuilt only when entries_version changes."""
+    version, html = st.session_state.sidebar_html
+    if version != st.session_state.entries_version:
+        html = "".join(
+            render_entry(e["category"], e["timestamp_display"], e["content"], e["tags"])
+            for e in reversed(st.session_state.journal_entries)
+        )
+        st.session_state.sidebar_html = (st.session_state.entries_version, html)
+    return html
 
 # ------------------- MAIN UI -------------------
 st.title("📔 AI Journal Assistant")
@@ -296,9 +518,27 @@ if prompt := st.chat_input("Type your message..."):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
+        chunks = process_message_stream(prompt)
         with st.spinner("Thinking..."):
-            reply = process_message(prompt)
-            st.markdown(reply)
+            first = next(chunks, "")
+        reply = st.write_stream(chain([first], chunks))
 
     st.session_state.chat_history.append({"role": "assistant", "content": reply})
-    st.rerun()
+
+# Drawn after the chat turn so entries added by it show up without a second rerun.
+with st.sidebar:
+    st.title("📒 Journal Entries")
+    st.metric("Total Entries", len(st.session_state.journal_entries))
+
+    if st.session_state.journal_entries:
+        st.markdown(sidebar_html(), unsafe_allow_html=True)
+
+    if st.button("🗑️ Clear All Entries", use_container_width=True):
+        st.session_state.journal_entries.clear()
+        st.session_state.chat_history.clear()
+        st.session_state.entries_by_cat.clear()
+        st.session_state.token_index.clear()
+        st.session_state.vocabulary.clear()
+        st.session_state.response_cache.clear()
+        st.session_state.entries_version += 1
+        st.rerun()